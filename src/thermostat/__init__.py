@@ -1,5 +1,7 @@
 from .data.dataset_utils import (
     Thermopack,
+    avg_attribution_stat,
+    explainer_agreement_stat,
     get_coordinate,
     load,
 )
@@ -7,4 +9,5 @@ from .data import thermostat_configs
 from .data import tokenization
 from .visualize import Heatmap
 
-__all__ = [Thermopack, get_coordinate, load, thermostat_configs, tokenization, Heatmap]
+__all__ = [Thermopack, avg_attribution_stat, explainer_agreement_stat, get_coordinate, load, thermostat_configs,
+           tokenization, Heatmap]
@@ -3,8 +3,9 @@ import os
 # new change 
 from sys import platform
 # new change
+from concurrent.futures import ProcessPoolExecutor
 from datasets import Dataset, load_dataset
-from itertools import groupby
+from functools import lru_cache
 from overrides import overrides
 from sklearn.metrics import classification_report
 from tqdm import tqdm
@@ -17,6 +18,19 @@ from thermostat.utils import lazy_property
 from thermostat.visualize import ColorToken, Heatmap, normalize_attributions
 
 
+@lru_cache(maxsize=None)
+def _get_tokenizer(model_name):
+    """ Process-wide tokenizer cache; AutoTokenizer.from_pretrained reads vocab files and builds
+     the backend tokenizer on every call, so each process pays for a model name only once """
+    return AutoTokenizer.from_pretrained(model_name)
+
+
+def _tokenize_batch(batch, model_name):
+    """ Convert the input ids of a batch of instances to tokens inside a datasets.map worker """
+    tokenizer = _get_tokenizer(model_name)
+    return {'tokens': [tokenizer.convert_ids_to_tokens(input_ids) for input_ids in batch['input_ids']]}
+
+
 class ThermopackMeta(type):
     """ Inspired by: https://stackoverflow.com/a/65917858 """
     def __new__(mcs, name, bases, dct):
@@ -36,7 +50,6 @@ class ThermopackMeta(type):
                 # Ignore if returns None
                 return None
             if type(result) == base:
-                print(fun_name)
                 # Return Child instance if the Base method tries to return Base instance.
                 return child(result)
             return result
@@ -57,18 +70,25 @@ class Thermopack(Dataset, metaclass=ThermopackMeta):
         self.explainer_name = get_coordinate(hf_dataset, 'Explainer')
 
         self.dataset: Dataset = hf_dataset
-        self.units: List = [PlaceholderThermounit(unit['attributions'],
-                                                  unit['idx'],
-                                                  unit['input_ids'],
-                                                  unit['label'],
-                                                  unit['predictions']) for unit in self.dataset]
+        # Structure-of-arrays layout: each column is held once as a NumPy array and every
+        # placeholder unit only keeps row views into them instead of per-row Python lists
+        numpy_dataset = hf_dataset.with_format('numpy', columns=['attributions', 'idx', 'input_ids',
+                                                                 'label', 'predictions'])
+        self.columns: Dict = {name: np.asarray(numpy_dataset[name])
+                              for name in ('attributions', 'idx', 'input_ids', 'label', 'predictions')}
+        self.units: List = [PlaceholderThermounit(self.columns['attributions'][i],
+                                                  self.columns['idx'][i],
+                                                  self.columns['input_ids'][i],
+                                                  self.columns['label'][i],
+                                                  self.columns['predictions'][i])
+                            for i in range(len(hf_dataset))]
         self.legacy_label_names = get_config(self.config_name).label_classes
 
     def __getattr__(self, name):
         """ Only gets called if an attribute that is not part of the Thermopack is accessed.
          In this case, if the name of the requested attribute is one of the five attributes of a Thermounit,
          return the respective entries of all units as a list """
-        if name in list(self.units[0].__dict__.keys()):
+        if name in self.units[0].attribute_names():
             return ThermounitAttributeArray([getattr(u, name) for u in self.units])
         else:
             raise AttributeError
@@ -80,7 +100,7 @@ class Thermopack(Dataset, metaclass=ThermopackMeta):
 
         if isinstance(idx, str):
             """ String indexing """
-            if idx in list(self.units[0].__dict__.keys()):
+            if idx in self.units[0].attribute_names():
                 """ Same behaviour as __getattr__: Return the requested attribute of all units as a list. """
                 return ThermounitAttributeArray([getattr(u, idx) for u in self.units])
             elif not any([isinstance(unit, Thermounit) for unit in self.units]):
@@ -102,11 +122,11 @@ class Thermopack(Dataset, metaclass=ThermopackMeta):
 
             # Overwrite true (HF dataset) label indices with custom label indices from downstream model
             #  (some MNLI and XNLI models have a different order in the label names)
-            true_label_index = self.label_names.index(self.legacy_label_names[instance.label])
+            true_label_index = self.label_alignment[instance.label]
             true_label = {'index': true_label_index,
                           'name': self.label_names[true_label_index]}
 
-            predicted_label_index = instance.predictions.index(max(instance.predictions))
+            predicted_label_index = int(np.argmax(instance.predictions))
             predicted_label = {'index': predicted_label_index,
                                'name': self.label_names[predicted_label_index]}
 
@@ -133,15 +153,30 @@ class Thermopack(Dataset, metaclass=ThermopackMeta):
         else:
             return self.legacy_label_names
 
+    @lazy_property
+    def label_alignment(self):
+        """ Maps legacy (HF dataset) label indices to the label order of the downstream model,
+         computed once instead of searching label_names for every unit """
+        return [self.label_names.index(name) for name in self.legacy_label_names]
+
     def decode(self):
         """ Replace all PlaceholderThermounit instances with fully processed Thermounit instances """
+        # Run the CPU-bound tokenizer conversion across processes and cache the tokens on the units,
+        # so instantiating the Thermounits below does not tokenize sequentially
+        # Clamp the worker count so small packs (e.g. slices) do not produce empty shards
+        num_proc = min(os.cpu_count(), len(self.dataset))
+        tokenized = self.dataset.map(_tokenize_batch, batched=True, batch_size=1000,
+                                     num_proc=num_proc, fn_kwargs={'model_name': self.model_name})
+        for unit, tokens in zip(self.units, tokenized['tokens']):
+            # Pre-fill the cache of the lazy tokens property
+            unit._lazy_tokens = dict(enumerate(tokens))
         for unit in tqdm(self, desc='Decoding Thermounits', total=len(self)):
             u = unit
 
     @lazy_property
     def tokenizer(self):
         """ Initializes the tokenizer from the model name """
-        return AutoTokenizer.from_pretrained(self.model_name)
+        return _get_tokenizer(self.model_name)
 
     def accuracy(self):
         return sum([u_i.true_label == u_i.predicted_label for u_i in self])/len(self)
@@ -154,7 +189,7 @@ class Thermopack(Dataset, metaclass=ThermopackMeta):
 
     def true_pred_counter(self):
         from collections import Counter
-        if 'true_label_index' not in self.units[0].__dict__:
+        if not hasattr(self.units[0], 'true_label_index'):
             self.decode()
         return Counter([(m_i.true_label_index, m_i.predicted_label_index) for m_i in self.units])
 
@@ -163,6 +198,10 @@ class PlaceholderThermounit:
     """ Raw single instance of a Thermopack. Accessing units of a Thermopack will automatically cast these to
      Thermounits. This class exists for efficiency purposes. Properly processing an entire dataset while loading it
      takes too long. """
+    # One placeholder exists per dataset row, so slots instead of a per-instance __dict__
+    # keep the footprint down; _lazy_tokens holds the cache of the tokens property
+    __slots__ = ('attributions', 'idx', 'input_ids', 'label', 'predictions', '_lazy_tokens')
+
     def __init__(self, attributions, idx, input_ids, label, predictions):
         self.attributions = attributions
         self.idx = idx
@@ -170,6 +209,12 @@ class PlaceholderThermounit:
         self.label = label
         self.predictions = predictions
 
+    def attribute_names(self) -> List:
+        """ Names of the attributes available on this unit (slots plus, for Thermounits, the instance dict) """
+        names = [name for name in self.__slots__ if not name.startswith('_') and hasattr(self, name)]
+        names += list(getattr(self, '__dict__', {}).keys())
+        return names
+
 
 class ThermounitAttributeArray(np.ndarray):
     """ NumPy Array of a list of attribute values of Thermopack units
@@ -193,10 +238,13 @@ class Thermounit(PlaceholderThermounit):
     """ Processed single instance of a Thermopack (Thermostat dataset/configuration) """
     def __init__(self, instance, true_label, predicted_label, model_name, dataset_name, explainer_name, tokenizer,
                  config_name):
-        if not isinstance(instance, Thermounit):
-            super().__init__(*instance.__dict__.values())
-        for key in instance.__dict__:
-            setattr(self, key, instance.__dict__[key])
+        # Copy the slotted fields (including a precomputed tokens cache) and any additional
+        # instance attributes of an already processed unit
+        for name in self.__slots__:
+            if hasattr(instance, name):
+                setattr(self, name, getattr(instance, name))
+        for key, value in getattr(instance, '__dict__', {}).items():
+            setattr(self, key, value)
         self.true_label = true_label['name']
         self.true_label_index = true_label['index']
         self.predicted_label = predicted_label['name']
@@ -210,10 +258,10 @@ class Thermounit(PlaceholderThermounit):
     def __len__(self):
         return len(self.explanation)
 
-    @property
+    @lazy_property
     def tokens(self) -> Dict:
         # "tokens" includes all special tokens, later used for the heatmap when aligning with attributions
-        tokens = self.tokenizer.convert_ids_to_tokens(self.input_ids)
+        tokens = self.tokenizer.convert_ids_to_tokens(np.asarray(self.input_ids).tolist())
         # Make token index
         tokens_enum = dict(enumerate(tokens))
         return tokens_enum
@@ -223,23 +271,43 @@ class Thermounit(PlaceholderThermounit):
         # Set text_fields attribute, e.g. containing "premise" and "hypothesis"
         return get_text_fields(self.config_name)
 
+    @property
+    def metadata(self) -> Dict:
+        """ Small dict of unit metadata handed to ColorTokens instead of the full instance dict """
+        return {'idx': self.idx,
+                'true_label': self.true_label,
+                'true_label_index': self.true_label_index,
+                'predicted_label': self.predicted_label,
+                'predicted_label_index': self.predicted_label_index,
+                'model_name': self.model_name,
+                'dataset_name': self.dataset_name,
+                'explainer_name': self.explainer_name,
+                'config_name': self.config_name}
+
     def fill_text_fields(self, fuse_subwords_strategy='salient'):
         """ Use detokenizer to fill text fields """
 
-        # Determine groups of tokens split by [SEP] tokens
+        # Determine groups of non-special tokens split by [SEP] tokens in a single pass
+        sep_token = self.tokenizer.sep_token
+        all_special_tokens = set(self.tokenizer.all_special_tokens)
         text_groups = []
-        for group in [list(g) for k, g in groupby(self.tokens.items(),
-                                                  lambda kt: kt[1] != self.tokenizer.sep_token) if k]:
-            # Remove groups that only contain special tokens
-            if len([t for t in group if t[1] not in self.tokenizer.all_special_tokens]) < len(group):
-                text_groups.append(group)
-
-        # Assign text field values based on groups
-        for text_field, field_tokens in zip(self.text_fields, text_groups):
-            # Create new list containing all non-special tokens
-            non_special_tokens_enum = [t for t in field_tokens if t[1] not in self.tokenizer.all_special_tokens]
+        current_group = []
+        for token_enum in self.tokens.items():
+            if token_enum[1] == sep_token:
+                # Groups that only contained special tokens stay empty and are dropped
+                if current_group:
+                    text_groups.append(current_group)
+                    current_group = []
+            elif token_enum[1] not in all_special_tokens:
+                current_group.append(token_enum)
+        if current_group:
+            text_groups.append(current_group)
+
+        # Assign text field values based on groups; build the metadata dict once and
+        # share it across all ColorTokens
+        metadata = self.metadata
+        for text_field, non_special_tokens_enum in zip(self.text_fields, text_groups):
             # Select attributions according to token indices (tokens_enum keys)
-
             selected_atts = [self.attributions[idx] for idx in [t[0] for t in non_special_tokens_enum]]
             if fuse_subwords_strategy:
                 tokens_enum, atts = fuse_subwords(non_special_tokens_enum, selected_atts, self.tokenizer,
@@ -254,7 +322,7 @@ class Thermounit(PlaceholderThermounit):
                                        attribution=att,
                                        text_field=text_field,
                                        token_index=token_enum[0],
-                                       thermounit_vars=vars(self))
+                                       thermounit_vars=metadata)
                             for token_enum, att in zip(tokens_enum, atts)]
 
             # Set class attribute with the name of the text field
@@ -270,8 +338,10 @@ class Thermounit(PlaceholderThermounit):
         if keep_padding_tokens:
             tokens = self.tokens
         else:
-            tokens = [(idx, token) for idx, token in self.tokens.items() if token != self.tokenizer.pad_token]
-        attributions = [att for i, att in enumerate(self.attributions) if i in [t[0] for t in tokens]]
+            pad_token = self.tokenizer.pad_token
+            tokens = [(idx, token) for idx, token in self.tokens.items() if token != pad_token]
+        token_indices = set(t[0] for t in tokens)
+        attributions = [att for i, att in enumerate(self.attributions) if i in token_indices]
         token_att_tuples = list(zip([t[1] for t in tokens], attributions, [t[0] for t in tokens]))
 
         return token_att_tuples
@@ -282,11 +352,12 @@ class Thermounit(PlaceholderThermounit):
          for a single data point of a Thermostat dataset """
 
         # Handle attributions, apply normalization and sign flipping if needed
-        atts = [x[1] for x in self.explanation]
+        atts = np.asarray([x[1] for x in self.explanation])
         if normalize:
             atts = normalize_attributions(atts)
         if flip_attributions_idx == self.predicted_label:
-            atts = [att * -1 for att in atts]
+            atts = -atts
+        atts = atts.tolist()
 
         non_pad_tokens_enum = [tuple(x[i] for i in [2, 0]) for x in self.explanation]
         if fuse_subwords_strategy:
@@ -297,12 +368,13 @@ class Thermounit(PlaceholderThermounit):
 
         assert (len(tokens_enum) == len(atts))
         # Cast each token into ColorToken objects with default color white which can later be overwritten
-        # by a Heatmap object
+        # by a Heatmap object; build the metadata dict once and share it across tokens
+        metadata = self.metadata
         color_tokens = [ColorToken(token=token_enum[1],
                                    attribution=att,
                                    text_field='text',
                                    token_index=token_enum[0],
-                                   thermounit_vars=vars(self))
+                                   thermounit_vars=metadata)
                         for token_enum, att in zip(tokens_enum, atts)]
         return Heatmap(color_tokens=color_tokens, attributions=atts, gamma=gamma)
 
@@ -363,14 +435,107 @@ def load(config_str: str = None, **kwargs) -> Thermopack:
     return Thermopack(data)
 
 
+def _attribution_sums_counts(thermostat_dataset: Dataset, vocab_size: int):
+    """ Accumulate per-token attribution sums and occurrence counts of one dataset (shard) """
+    # Two bincount passes over contiguous arrays replace per-token Python dict updates and decode calls
+    numpy_dataset = thermostat_dataset.with_format('numpy', columns=['input_ids', 'attributions', 'label'])
+    ids = np.asarray(numpy_dataset['input_ids'], dtype=np.int32)
+    atts = np.asarray(numpy_dataset['attributions'], dtype=np.float32)
+    labels = np.asarray(numpy_dataset['label'])
+
+    # Flip the sign of the attributions of instances with label 0 via a broadcasted multiplier
+    signs = np.where(labels == 0, -1.0, 1.0)[:, None]
+    flat_ids = ids.ravel()
+    sums = np.bincount(flat_ids, weights=(atts * signs).ravel(), minlength=vocab_size)
+    counts = np.bincount(flat_ids, minlength=vocab_size)
+    return sums, counts
+
+
+def avg_attribution_stat(thermostat_dataset: Dataset, num_proc: int = None) -> Dict:
+    """ Given a Thermostat dataset, calculate the average attribution of each token across the whole dataset.
+     The accumulation is embarrassingly parallel: pass num_proc to split it into shards across processes
+     and reduce their sums and counts, which scales near-linearly with cores on large datasets. """
+    model_id = get_coordinate(thermostat_dataset, coordinate='Model')
+    tokenizer = _get_tokenizer(model_id)
+
+    # Work on the plain HF dataset: sharding or formatting a Thermopack would re-wrap every
+    # result through ThermopackMeta, eagerly rebuilding its columns and units per shard
+    dataset = thermostat_dataset.dataset if isinstance(thermostat_dataset, Thermopack) else thermostat_dataset
+
+    if num_proc and num_proc > 1:
+        shards = [dataset.shard(num_shards=num_proc, index=i) for i in range(num_proc)]
+        with ProcessPoolExecutor(max_workers=num_proc) as executor:
+            shard_results = list(executor.map(_attribution_sums_counts, shards, [tokenizer.vocab_size] * num_proc))
+        sums = np.sum([r[0] for r in shard_results], axis=0)
+        counts = np.sum([r[1] for r in shard_results], axis=0)
+    else:
+        sums, counts = _attribution_sums_counts(dataset, tokenizer.vocab_size)
+
+    # Decode each unique input id exactly once, after the reduce
+    return {tokenizer.decode([input_id]): sums[input_id] / counts[input_id]
+            for input_id in np.nonzero(counts)[0]}
+
+
+def explainer_agreement_stat(thermostat_datasets: List) -> List:
+    """ Calculate the agreement on token attribution scores between multiple Thermostat datasets """
+    # Validate once up front; isinstance also admits Dataset subclasses such as Thermopack
+    assert all(isinstance(td, Dataset) for td in thermostat_datasets)
+
+    model_id = get_coordinate(thermostat_datasets[0], coordinate='Model')
+    tokenizer = _get_tokenizer(model_id)
+
+    # Convert every id in the vocabulary once up front instead of decoding each occurrence separately
+    id2tok = tokenizer.convert_ids_to_tokens(list(range(tokenizer.vocab_size)))
+
+    # Work on the plain HF datasets: formatting a Thermopack would re-wrap every result through
+    # ThermopackMeta and duplicate the whole pack just to read one column
+    hf_datasets = [td.dataset if isinstance(td, Thermopack) else td for td in thermostat_datasets]
+
+    # Pull the needed columns once as NumPy arrays instead of boxing every row into Python objects
+    input_ids = np.asarray(hf_datasets[0].with_format('numpy', columns=['input_ids'])['input_ids'])
+    all_explainers_atts = [np.asarray(td.with_format('numpy', columns=['attributions'])['attributions'])
+                           for td in hf_datasets]
+
+    # Stack the explainers into one [N, T, E] array and reduce over the explainer axis in a single
+    # vectorized pass; special tokens are masked out so only kept positions hit the Python loop below
+    atts = np.stack(all_explainers_atts, axis=-1)
+    dissim = atts.max(axis=-1) - atts.min(axis=-1)
+    mask = ~np.isin(input_ids, tokenizer.all_special_ids)
+
+    dissimilarity_by_token = []
+    for row_index in tqdm(range(len(input_ids))):
+        row_ids = input_ids[row_index]
+        # Decode the context of the row once instead of once per token
+        context = tokenizer.decode(row_ids, skip_special_tokens=True)
+        for idx in np.nonzero(mask[row_index])[0]:
+            dissimilarity_by_token.append((id2tok[row_ids[idx]],
+                                           dissim[row_index, idx],
+                                           context))
+
+    # Most dissimilar tokens first
+    return sorted(dissimilarity_by_token, key=lambda x: x[1], reverse=True)
+
+
+@lru_cache(maxsize=None)
+def _parse_coordinates(description: str) -> Dict:
+    """ Extract all coordinates of a dataset description in one pass, cached per description string """
+    coordinates = {}
+    for coordinate in ['Model', 'Dataset', 'Explainer']:
+        coord_prefix = f'{coordinate}: '
+        if coord_prefix not in description:
+            continue
+        str_post_coord_prefix = description.split(coord_prefix)[1]
+        if '\n' in str_post_coord_prefix:
+            coord_value = str_post_coord_prefix.split('\n')[0]
+        else:
+            coord_value = str_post_coord_prefix
+        coordinates[coordinate] = coord_value
+    return coordinates
+
+
 def get_coordinate(thermostat_dataset: Dataset, coordinate: str) -> str:
     """ Determine a coordinate (dataset, model, or explainer) of a Thermostat dataset from its description """
     assert coordinate in ['Model', 'Dataset', 'Explainer']
-    coord_prefix = f'{coordinate}: '
-    assert coord_prefix in thermostat_dataset.description
-    str_post_coord_prefix = thermostat_dataset.description.split(coord_prefix)[1]
-    if '\n' in str_post_coord_prefix:
-        coord_value = str_post_coord_prefix.split('\n')[0]
-    else:
-        coord_value = str_post_coord_prefix
-    return coord_value
+    coordinates = _parse_coordinates(thermostat_dataset.description)
+    assert coordinate in coordinates
+    return coordinates[coordinate]
@@ -1,6 +1,7 @@
 import datasets
 import glob
 import json
+import numpy as np
 import pandas as pd
 import streamlit as st
 import sys
@@ -163,7 +164,7 @@ if start:
         )
     else:
         d = dts
-        keys = list(d[0].__dict__.keys())
+        keys = d[0].attribute_names()
 
         st.header(
             "Thermostat configuration: "
@@ -245,6 +246,10 @@ if start:
                 for k in on_keys:
                     v = getattr(d[item], k)
 
+                    # NumPy row views of the unit columns are not JSON serializable
+                    if isinstance(v, np.ndarray):
+                        v = v.tolist()
+
                     # Remove [PAD] tokens from attributions and input_ids
                     if k in ['attributions', 'input_ids']:
                         v = [vi for vi in v if vi != 0 or vi != 0.0]
@@ -1,5 +1,6 @@
 import math
 import numpy as np
+from itertools import accumulate
 import os
 import pandas as pd
 import torch
@@ -13,7 +14,31 @@ from thermostat.data import get_local_explanations
 from thermostat.utils import delistify, detach_to_list, read_path
 
 
+# displaCy entity templates, built once at import time instead of inside every render call
+ENT_TEMPLATE_WITH_LABELS = """
+            <mark class="entity" style="background: {bg}; padding: 0.45em 0.6em; margin: 0 0.25em; line-height: 2;
+            border-radius: 0.35em; box-decoration-break: clone; -webkit-box-decoration-break: clone">
+                {text}
+                <span style="font-size: 0.8em; font-weight: bold; line-height: 1; border-radius: 0.35em; text-transform:
+                uppercase; vertical-align: middle; margin-left: 0.5rem">{label}</span>
+            </mark>
+            """
+
+ENT_TEMPLATE = """
+            <mark class="entity" style="background: {bg}; padding: 0.15em 0.3em; margin: 0 0.2em; line-height: 2.2;
+            border-radius: 0.25em; box-decoration-break: clone; -webkit-box-decoration-break: clone">
+                {text}
+            </mark>
+            """
+
+
 class ColorToken:
+    # One ColorToken is allocated per token per heatmap; slots cover the token data plus the
+    # unit metadata passed in via thermounit_vars
+    __slots__ = ('token', 'attribution', 'text_field', 'token_index', 'red', 'green', 'blue', 'score',
+                 'idx', 'true_label', 'true_label_index', 'predicted_label', 'predicted_label_index',
+                 'model_name', 'dataset_name', 'explainer_name', 'config_name')
+
     def __init__(self, token, attribution, text_field, token_index, thermounit_vars: Dict):
         self.token = token
         self.attribution = attribution
@@ -50,7 +75,7 @@ class ColorToken:
         setattr(self, 'score', round(score, ndigits=3))
 
     def __repr__(self):
-        if "score" in vars(self):
+        if self.score is not None:
             score_str = f'Score: {self.score}'
         else:
             score_str = f'Attribution: {self.attribution}'
@@ -93,7 +118,7 @@ class Heatmap(TextField):
     def __getitem__(self, idx):
         if isinstance(idx, str):
             """ String indexing """
-            if idx in list(self[0].__dict__.keys()):
+            if idx in ColorToken.__slots__:
                 return [getattr(u, idx) for u in self]
         return list(self)[idx]
 
@@ -110,60 +135,42 @@ class Heatmap(TextField):
                 Heatmap([t for t in self if t.text_field == field]).render(labels=labels)
             return
 
-        ents = []
-        colors = {}
-        ii = 0
-        for color_token in self:
-            ff = ii + len(color_token.token)
-
-            # One entity in displaCy contains start and end markers (character index) and optionally a label
-            # The label can be added by setting "attribution_labels" to True
-            ent = {
-                'start': ii,
-                'end': ff,
-                'label': str(color_token.score),
-            }
-
-            ents.append(ent)
-            # A "colors" dict takes care of the mapping between attribution labels and hex colors
-            colors[str(color_token.score)] = color_token.hex()
-            ii = ff
+        # Collect tokens and score labels once, then derive the character offsets with a running sum
+        tokens = [t.token for t in self]
+        score_labels = [str(t.score) for t in self]
+        ends = list(accumulate(map(len, tokens)))
+        starts = [0] + ends[:-1]
+
+        # One entity in displaCy contains start and end markers (character index) and optionally a label
+        # The label can be added by setting "attribution_labels" to True
+        ents = [{'start': start, 'end': end, 'label': score_label}
+                for start, end, score_label in zip(starts, ends, score_labels)]
+        # A "colors" dict takes care of the mapping between attribution labels and hex colors
+        colors = {score_label: color_token.hex() for score_label, color_token in zip(score_labels, self)}
 
         to_render = {
-            'text': ''.join([t.token for t in self]),
+            'text': ''.join(tokens),
             'ents': ents,
         }
         # print(to_render)
 
-        if labels:
-            template = """
-            <mark class="entity" style="background: {bg}; padding: 0.45em 0.6em; margin: 0 0.25em; line-height: 2;
-            border-radius: 0.35em; box-decoration-break: clone; -webkit-box-decoration-break: clone">
-                {text}
-                <span style="font-size: 0.8em; font-weight: bold; line-height: 1; border-radius: 0.35em; text-transform:
-                uppercase; vertical-align: middle; margin-left: 0.5rem">{label}</span>
-            </mark>
-            """
-        else:
-            template = """
-            <mark class="entity" style="background: {bg}; padding: 0.15em 0.3em; margin: 0 0.2em; line-height: 2.2;
-            border-radius: 0.25em; box-decoration-break: clone; -webkit-box-decoration-break: clone">
-                {text}
-            </mark>
-            """
+        template = ENT_TEMPLATE_WITH_LABELS if labels else ENT_TEMPLATE
 
         html = displacy.render(
             to_render,
             style='ent',
             manual=True,
-            # jupyter=is_in_jupyter(),
+            jupyter=False,
             options={'template': template,
                      'colors': colors,
                      },
             # minify=True,
         )
-        # print(html)
-        # return html if not is_in_jupyter() else None
+        if is_in_jupyter():
+            # Display the already rendered string instead of calling displacy.render a second
+            # time with jupyter=True, which would process all entity spans again
+            from IPython.display import display, HTML
+            display(HTML(html))
         return html
 
 
@@ -199,8 +206,9 @@ def append_heatmap(tokens, scores, latex, gamma, caption, pad_token, formatting=
 
 
 def normalize_attributions(attributions):
-    max_abs_score = max(max(attributions), abs(min(attributions)))
-    return [(score / max_abs_score) for score in attributions]
+    attributions = np.asarray(attributions)
+    max_abs_score = np.abs(attributions).max()
+    return attributions / max_abs_score
 
 
 def run_visualize(config: Dict, dataset=None):
@@ -252,7 +260,7 @@ def run_visualize(config: Dict, dataset=None):
         if 'predictions' in instance:
             preds = instance['predictions']
             summary['Logits'] = detach_to_list(preds)
-            preds_max = torch.argmax(preds) if type(preds) == torch.Tensor else preds.index(max(preds))
+            preds_max = torch.argmax(preds) if type(preds) == torch.Tensor else int(np.argmax(preds))
             preds_max_detached = detach_to_list(preds_max)
             summary['Predicted Label'] = str(label_names[preds_max_detached])
         html += summarize(summary)